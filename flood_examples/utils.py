@@ -1,7 +1,7 @@
 """uavsar.py: utilities for manipulating uavsar images"""
 from __future__ import division
 import numpy as np
-from scipy.ndimage.interpolation import shift
+from scipy.ndimage import shift
 
 import sario
 
@@ -12,10 +12,10 @@ def split_array_into_blocks(data):
     Useful to look at small data pieces at a time in dismph
 
     Returns:
-        blocks (list[np.ndarray])
+        blocks (list[np.ndarray]): views into `data` (no copies are made)
     """
     rows, cols = data.shape
-    blocks = np.array_split(data, np.ceil(rows / cols))
+    blocks = np.array_split(data, int(np.ceil(rows / cols)))
     return blocks
 
 
@@ -88,7 +88,8 @@ def crop_to_smallest(image_list):
         image_list (iterable[ndarray]): list of images, or 3D array
             with 1st axis as the image number
     Returns:
-        list[ndarray]: images of all same size
+        list[ndarray]: images of all same size. These are views of the inputs,
+            so use np.ascontiguousarray if a contiguous copy is needed
 
     Example:
     >>> a = np.arange(10).reshape((5, 2))
@@ -150,6 +151,29 @@ def align_image_pair(image_pair, info_list, verbose=True):
     offset_tup = offset(img1_ann, img2_ann)
     if verbose:
         print("Offset (rows, cols): {}".format(offset_tup))
+    int_offsets = np.round(offset_tup)
+    if np.allclose(offset_tup, int_offsets, rtol=0, atol=1e-6):
+        # Whole-pixel offsets need no interpolation
+        return _shift_integer(img2, int(int_offsets[0]), int(int_offsets[1]))
     # Note: we use order=1 since default order=3 spline was giving
     # negative values for images (leading to invalid nonsense)
     return shift(img2, offset_tup, order=1)
+
+
+def _shift_integer(img, row_shift, col_shift):
+    """Shifts `img` by a whole number of pixels, filling in with 0s
+
+    Same result as scipy.ndimage.shift for integer shifts, without interpolating
+    """
+    out = np.zeros_like(img)
+    rows, cols = img.shape
+    if abs(row_shift) >= rows or abs(col_shift) >= cols:
+        return out
+    out[
+        max(row_shift, 0) : rows + min(row_shift, 0),
+        max(col_shift, 0) : cols + min(col_shift, 0),
+    ] = img[
+        max(-row_shift, 0) : rows + min(-row_shift, 0),
+        max(-col_shift, 0) : cols + min(-col_shift, 0),
+    ]
+    return out
@@ -14,11 +14,11 @@ setuptools.setup(
         "Topic :: Scientific/Engineering",
         "Intended Audience :: Science/Research",
     ],
+    python_requires=">=3.6",
     install_requires=["requests"],
     extras_require={
-        ':python_version == "2.7"': ["futures"],
         # for 'pip install .[geoslc]'
-        "geoslc": ["numpy", "h5py", "numba", "joblib"],
+        "geoslc": ["numpy", "h5py", "numba"],
     },
     entry_points={
         "console_scripts": [
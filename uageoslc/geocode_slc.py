@@ -1,16 +1,14 @@
-import os
-import shutil
 import numpy as np
-from math import ceil, floor, cos, sin, sqrt
+from math import ceil, floor, cos, sin, pi, isnan
 import numba
-from numba import njit, cuda, jit
+from numba import njit, cuda, jit, prange
+from numba.cuda import libdevice
 from uaquery.logger import get_log, log_runtime
 
 log = get_log()
 
 from . import orbit, orbit_gpu, parsers, utils
-
-from joblib import Parallel, delayed
+from .constants import EARTH_E2, EARTH_SMA
 
 
 @log_runtime
@@ -32,12 +30,16 @@ def main(
         )
         log.info("Writing results to %s", outfile)
     uav = parsers.UavsarHDF5(hdf5_file)
-    lam = uav.get_wavelength(frequency)
+    metadata = uav.preload_metadata(frequency)
+    lam = metadata["wavelength"]
 
     # Get orbit time, position, velocity
-    tt, xx, vv = uav.get_orbit()
+    # The orbit routines take (3, N) arrays, so each component is contiguous
+    tt, xx, vv = metadata["orbit"]
+    xx = np.ascontiguousarray(xx.T)
+    vv = np.ascontiguousarray(vv.T)
 
-    slant_ranges = uav.get_slant_ranges(frequency)
+    slant_ranges = metadata["slant_ranges"]
     # Slant range limits and spacing
     r_near, r_far = slant_ranges[0], slant_ranges[-1]
     delta_r = slant_ranges[1] - slant_ranges[0]
@@ -46,7 +48,7 @@ def main(
     # Get azimuth time data: limits, spacing (pulse repitition interval)
     # prf = uav.get_prf(frequency)
     # pri = uav.get_pri()
-    zero_dop_times = uav.get_zero_doppler_times()
+    zero_dop_times = metadata["zero_doppler_times"]
     t_start, t_end = zero_dop_times[0], zero_dop_times[-1]
     pri = zero_dop_times[1] - zero_dop_times[0]
     log.info("Start, end pulse times, PRI: %s, %s, %s", t_start, t_end, pri)
@@ -82,25 +84,9 @@ def main(
             delta_r,
         )
     else:
-        log.info("Loading DEM:")
-        dem = utils.load_dem(demfile)
-        log.info("dem.shape = %s", dem.shape)
-
-        threadsperblock = (16, 16)
-        blockspergrid_x = ceil(dem.shape[0] / threadsperblock[0])
-        blockspergrid_y = ceil(dem.shape[1] / threadsperblock[1])
-        blockspergrid = (blockspergrid_x, blockspergrid_y)
-        log.info("Geocoding and phase compensating SLC on GPU")
-        log.info(
-            "(blocks per grid, threads per block) = ((%s, %s), (%s, %s))",
-            *blockspergrid,
-            *threadsperblock
-        )
-
-        out = np.zeros(dem.shape, dtype=slc.dtype)
-        geocode_gpu[blockspergrid, threadsperblock](
+        out = geocode_gpu_blocks(
             slc,
-            dem,
+            demfile,
             lat_arr,
             lon_arr,
             lam,
@@ -113,7 +99,6 @@ def main(
             r_near,
             r_far,
             delta_r,
-            out,
         )
 
     if outfile:
@@ -121,149 +106,293 @@ def main(
     return out
 
 
-@njit(nogil=True)
+@njit(nogil=True, cache=True)
 def interp(slc, az_idx, rg_idx):
     """Interpolate the image `slc` at fractional az bin (row) `az_idx`
-    and fractional range bin index `rg_idx`"""
-    az_floor = int(floor(az_idx))
-    az_ceil = int(ceil(az_idx))
-    pct_to_ceil_az = az_idx - floor(az_idx)
+    and fractional range bin index `rg_idx` (both >= 0)"""
+    # Neighbors are at floor and floor + 1: clip so that floor + 1 stays in the
+    # image on its last row/col (the weight of the floor sample is then 0)
+    az_floor = min(int(az_idx), slc.shape[0] - 2)
+    rg_floor = min(int(rg_idx), slc.shape[1] - 2)
+    # Weights are single precision to match the (complex64) SLC: the indices
+    # themselves stay float64, but the fractions don't need it
+    pct_to_ceil_az = numba.float32(az_idx - az_floor)
+    pct_to_ceil_rg = numba.float32(rg_idx - rg_floor)
+
+    s00 = slc[az_floor, rg_floor]
+    s01 = slc[az_floor, rg_floor + 1]
+    s10 = slc[az_floor + 1, rg_floor]
+    s11 = slc[az_floor + 1, rg_floor + 1]
+    # Interpolate in the range direction, then these results in azimuth
+    rg_interped_low = s00 + pct_to_ceil_rg * (s01 - s00)
+    rg_interped_high = s10 + pct_to_ceil_rg * (s11 - s10)
+    return rg_interped_low + pct_to_ceil_az * (rg_interped_high - rg_interped_low)
+
+
+@njit(nogil=True, cache=True)
+def outside_pulses(xyz, satx_start, satv_start, satx_end, satv_end):
+    """Check if the zero doppler time of `xyz` is before the satellite state
+    (`satx_start`, `satv_start`), or after (`satx_end`, `satv_end`)
+
+    The doppler dot(xyz - satx, satv) decreases through 0 at the zero doppler
+    time, so it's already negative at the start state if the time is earlier.
+    """
+    dr_start = (
+        xyz[0] - satx_start[0],
+        xyz[1] - satx_start[1],
+        xyz[2] - satx_start[2],
+    )
+    if orbit.dot(dr_start, satv_start) < 0:
+        return True
+    dr_end = (xyz[0] - satx_end[0], xyz[1] - satx_end[1], xyz[2] - satx_end[2])
+    return orbit.dot(dr_end, satv_end) > 0
 
-    rg_floor = int(floor(rg_idx))
-    rg_ceil = int(ceil(rg_idx))
-    pct_to_ceil_rg = rg_idx - floor(rg_idx)
 
-    # Interpolate in the range direction for floor, ceil of az index
-    rg_interped_low = (1 - pct_to_ceil_rg) * slc[
-        az_floor, rg_floor
-    ] + pct_to_ceil_rg * slc[az_floor, rg_ceil]
-    rg_interped_high = (1 - pct_to_ceil_rg) * slc[
-        az_ceil, rg_floor
-    ] + pct_to_ceil_rg * slc[az_ceil, rg_ceil]
-    # Then interpolate these results in the azimuth direction
-    return (1 - pct_to_ceil_az) * rg_interped_low + pct_to_ceil_az * rg_interped_high
+def get_phase_lut(lam, r_near, delta_r, num_ranges):
+    """Range phase compensation exp(j*4*pi*r/lam) for each slant range bin
+
+    Per-pixel phasors are formed as `phase_lut[rg_floor] * exp(j*frac_phase)`,
+    where `frac_phase` is the phase across the fraction of a bin past `rg_floor`.
+    Wrapped to [0, 2pi), the fractional phase is accurate in single precision,
+    unlike the full phase (~1e6 radians).
+    """
+    bin_ranges = r_near + delta_r * np.arange(num_ranges)
+    return np.exp(1j * 4.0 * pi * bin_ranges / lam).astype(np.complex64)
+
 
+# Max. (rows, cols) of the SLC cached in shared memory by one GPU block
+SLC_TILE_SHAPE = (64, 64)
+# Max. number of orbit samples copied into shared memory by each GPU block
+# (7 float64 values per sample: with the SLC tile, stays under 48 KB)
+ORBIT_SHARED_LEN = 256
 
-@cuda.jit
+
+@cuda.jit(cache=True)
 def geocode_gpu(
     slc,
     dem,
-    lat_arr,
-    lon_arr,
-    lam,
+    rad_earth,
+    sin_lat,
+    cos_lat,
+    sin_lon,
+    cos_lon,
+    bin_phase,
     tt,
     xx,
     vv,
     t_start,
     t_end,
-    pri,
+    inv_pri,
     r_near,
     r_far,
-    delta_r,
+    inv_delta_r,
+    pulse_states,
+    phase_lut,
     out,
 ):
     # num_lines = slc.shape[0]
     # nlat = len(lat_arr)
     # nlon = len(lon_arr)
 
-    # Check for GPU bounds
-    i, j = cuda.grid(2)
-    if not (0 <= i < out.shape[0] and 0 <= j < out.shape[1]):
-        # and not (0 <= i < dem.shape[0] and 0 <= j < dem.shape[1]):
-        # Skip this thread if it's out of bounds
-        # Maybe need more checks if i break into DEM blocks
-        return
+    # SLC pixels needed by this block: (az min, az max, range min, range max)
+    slc_bounds = cuda.shared.array(4, dtype=numba.int32)
+    slc_tile = cuda.shared.array(SLC_TILE_SHAPE, dtype=numba.complex64)
+    tx, ty = cuda.threadIdx.x, cuda.threadIdx.y
+    num_threads = cuda.blockDim.x * cuda.blockDim.y
+    if tx == 0 and ty == 0:
+        slc_bounds[0] = slc.shape[0]
+        slc_bounds[1] = -1
+        slc_bounds[2] = slc.shape[1]
+        slc_bounds[3] = -1
+    # Every thread reads the (small) orbit arrays many times in the zero doppler
+    # search, so copy them into shared memory once per block if they fit
+    tt_s = cuda.shared.array(ORBIT_SHARED_LEN, dtype=numba.float64)
+    xx_s = cuda.shared.array((3, ORBIT_SHARED_LEN), dtype=numba.float64)
+    vv_s = cuda.shared.array((3, ORBIT_SHARED_LEN), dtype=numba.float64)
+    n_orbit = tt.shape[0]
+    orbit_shared = n_orbit <= ORBIT_SHARED_LEN
+    if orbit_shared:
+        for k in range(ty * cuda.blockDim.x + tx, n_orbit, num_threads):
+            tt_s[k] = tt[k]
+            for c in range(3):
+                xx_s[c, k] = xx[c, k]
+                vv_s[c, k] = vv[c, k]
+    cuda.syncthreads()
 
-    lat = lat_arr[i]
-    lon = lon_arr[j]
-    h = dem[i, j]
-    # output: into the thread-local xyz
-    xyz_temp = cuda.local.array(3, dtype=numba.float64)
-    orbit_gpu.llh_to_xyz_single(lat, lon, h, xyz_temp)
-
-    # make thread-local containers for sat x/v and LOS vec
-    satx = cuda.local.array(3, dtype=numba.float64)
-    satv = cuda.local.array(3, dtype=numba.float64)
-    dr_vec = cuda.local.array(3, dtype=numba.float64)
-    tline, cur_range = orbit_gpu.orbitrangetime_gpu(
-        xyz_temp,
-        tt,
-        xx,
-        vv,
-        satx,
-        satv,
-        dr_vec,
-    )
+    # Check for GPU bounds
+    # Note: no early returns until the tile is loaded, since all threads
+    # in the block need to reach `syncthreads`
+    j, i = cuda.grid(2)
+    in_bounds = 0 <= i < out.shape[0] and 0 <= j < out.shape[1]
+    valid = in_bounds
+    az_idx = 0.0
+    rg_idx = 0.0
+    cur_range = 0.0
+    if valid:
+        # `rad_earth` is the `orbit.earth_radius` of each row's latitude
+        xyz_temp = orbit.llh_to_xyz_trig(
+            rad_earth[i], sin_lat[i], cos_lat[i], sin_lon[j], cos_lon[j], dem[i, j]
+        )
+        # Skip the zero doppler search for pixels before/after the SLC's pulses
+        # (`pulse_states`: position, velocity tuples just before the first pulse,
+        # then just after the last)
+        valid = not outside_pulses(
+            xyz_temp, pulse_states[0], pulse_states[1], pulse_states[2], pulse_states[3]
+        )
+    if valid:
+        # make thread-local containers for sat x/v and LOS vec
+        satx = cuda.local.array(3, dtype=numba.float64)
+        satv = cuda.local.array(3, dtype=numba.float64)
+        dr_vec = cuda.local.array(3, dtype=numba.float64)
+        if orbit_shared:
+            tline, cur_range = orbit_gpu.orbitrangetime_gpu(
+                xyz_temp,
+                tt_s[:n_orbit],
+                xx_s[:, :n_orbit],
+                vv_s[:, :n_orbit],
+                satx,
+                satv,
+                dr_vec,
+            )
+        else:
+            tline, cur_range = orbit_gpu.orbitrangetime_gpu(
+                xyz_temp,
+                tt,
+                xx,
+                vv,
+                satx,
+                satv,
+                dr_vec,
+            )
 
-    if tline < t_start or tline > t_end:
-        return
-    if cur_range < r_near or cur_range > r_far:
+        if tline < t_start or tline > t_end:
+            valid = False
+        if cur_range < r_near or cur_range > r_far:
+            valid = False
+
+    if valid:
+        az_idx = (tline - t_start) * inv_pri
+        rg_idx = (cur_range - r_near) * inv_delta_r
+        # Same (clamped) neighbors that `interp` reads, so the tile never
+        # reaches past the last SLC row/column
+        az_low = min(int(floor(az_idx)), slc.shape[0] - 2)
+        rg_low = min(int(floor(rg_idx)), slc.shape[1] - 2)
+        cuda.atomic.min(slc_bounds, 0, az_low)
+        cuda.atomic.max(slc_bounds, 1, az_low + 1)
+        cuda.atomic.min(slc_bounds, 2, rg_low)
+        cuda.atomic.max(slc_bounds, 3, rg_low + 1)
+    cuda.syncthreads()
+
+    # If the block's part of the SLC fits, load it into shared memory together
+    az_min = slc_bounds[0]
+    rg_min = slc_bounds[2]
+    n_az = slc_bounds[1] - az_min + 1
+    n_rg = slc_bounds[3] - rg_min + 1
+    # (bounds are left unset, so n_az < 1, if no pixel in the block is valid)
+    use_tile = 0 < n_az <= SLC_TILE_SHAPE[0] and n_rg <= SLC_TILE_SHAPE[1]
+    if use_tile:
+        for k in range(ty * cuda.blockDim.x + tx, n_az * n_rg, num_threads):
+            row = k // n_rg
+            col = k % n_rg
+            slc_tile[row, col] = slc[az_min + row, rg_min + col]
+    cuda.syncthreads()
+
+    if not valid:
+        # `out` may be uninitialized device memory, so fill in the skipped pixels
+        if in_bounds:
+            out[i, j] = 0
         return
 
-    # if i == 0 and j == 0:
-    #     print(tline, cur_range)
-    az_idx = (tline - t_start) / pri
-    rg_idx = (cur_range - r_near) / delta_r
-
     # Interpolate between az/range
-    slc_interp = interp(slc, az_idx, rg_idx)
-    # add the phase compensation for range
-    phase = 4.0 * 3.1415926535 * cur_range / lam
-    phase_cpx = cos(phase) + 1j * sin(phase)
-    out[i, j] = slc_interp * phase_cpx
+    if use_tile:
+        # Only the loaded part of the tile, so `interp` stays inside it
+        slc_interp = interp(
+            slc_tile[:n_az, :n_rg], az_idx - az_min, rg_idx - rg_min
+        )
+    else:
+        slc_interp = interp(slc, az_idx, rg_idx)
+    # add the phase compensation for range: table value at the range bin,
+    # times the (small) extra phase for the fraction of a bin past it
+    rg_floor = int(floor(rg_idx))
+    frac_phase = bin_phase * (rg_idx - floor(rg_idx))
+    # wrap to [0, 2pi) before dropping to single precision
+    frac_phase -= 2 * pi * floor(frac_phase / (2 * pi))
+    sin_phase, cos_phase = libdevice.sincosf(numba.float32(frac_phase))
+    frac_phasor = numba.complex64(complex(cos_phase, sin_phase))
+    out[i, j] = numba.complex64(slc_interp) * (frac_phasor * phase_lut[rg_floor])
 
 
-# @njit
-def _geocode_cpu_row(
-    i,
+@njit(nogil=True, parallel=True, cache=True)
+def _geocode_cpu_rows(
     slc,
     dem,
     lat_arr,
-    lon_arr,
-    lam,
+    sin_lon,
+    cos_lon,
     tt,
     xx,
     vv,
+    bin_phase,
     t_start,
     t_end,
     pri,
     r_near,
     r_far,
     delta_r,
+    phase_lut,
     out,
 ):
-
-    if i % 100 == 0:
-        print("Processing row", i, "/", dem.shape[0])
-
-    row = np.zeros(dem.shape[1], dtype=np.complex64)
-    for j in range(dem.shape[1]):
-        lat = lat_arr[i]
-        lon = lon_arr[j]
-        h = dem[i, j]
-        xyz = orbit.llh_to_xyz(lat, lon, h)
-
-        tline, dr_vec = orbit.orbitrangetime(xyz, tt, xx, vv)
-        if tline < t_start or tline > t_end:
-            continue
-        cur_range = sqrt(dr_vec[0] ** 2 + dr_vec[1] ** 2 + dr_vec[2] ** 2)
-        if cur_range < r_near or cur_range > r_far:
-            continue
-
-        # Get the fractional indices for range and azimuth
-        az_idx = (tline - t_start) / pri
-        rg_idx = (cur_range - r_near) / delta_r
-
-        # Interpolate az/range, add the phase compensation for range
-        slc_interp = interp(slc, az_idx, rg_idx)
-        # add the phase compensation for range
-        phase = 4.0 * 3.1415926535 * cur_range / lam
-        phase_cpx = cos(phase) + 1j * sin(phase)
-        # return slc_interp * phase_cpx
-        # out[i, j] = slc_interp * phase_cpx
-        row[j] = slc_interp * phase_cpx
-    out[i, :] = row
-    # return row
+    """Geocode and phase compensate a block of DEM rows, writing into `out`
+
+    Same per-pixel steps as `geocode_gpu`, with rows processed in parallel.
+    `sin_lon`, `cos_lon` are the sine/cosine of the DEM's longitudes.
+    `bin_phase` is the two-way phase across one range bin, 4*pi*delta_r/lam.
+    Pixels outside the SLC's time/range bounds are not written.
+    """
+    # Satellite state just outside the first/last pulse, to skip the Newton
+    # iteration for pixels before/after the SLC
+    satx_start, satv_start = orbit.intp_orbit(tt, xx, vv, t_start - pri)
+    satx_end, satv_end = orbit.intp_orbit(tt, xx, vv, t_end + pri)
+    # Multiply by these in the loop instead of dividing
+    inv_pri = 1.0 / pri
+    inv_delta_r = 1.0 / delta_r
+    for i in prange(dem.shape[0]):
+        # Trig for the ECEF conversion: once per row for lat, once total for lon
+        sin_lat = sin(lat_arr[i])
+        cos_lat = cos(lat_arr[i])
+        rad_earth = orbit.earth_radius(sin_lat)
+        # Neighboring pixels have nearly the same zero doppler time, so each
+        # pixel's Newton iteration starts from the last one's solution
+        n = len(tt)
+        tline0 = tt[n // 2]
+        satx0 = (xx[0, n // 2], xx[1, n // 2], xx[2, n // 2])
+        satv0 = (vv[0, n // 2], vv[1, n // 2], vv[2, n // 2])
+        for j in range(dem.shape[1]):
+            xyz = orbit.llh_to_xyz_trig(
+                rad_earth, sin_lat, cos_lat, sin_lon[j], cos_lon[j], dem[i, j]
+            )
+            if outside_pulses(xyz, satx_start, satv_start, satx_end, satv_end):
+                continue
+            tline, cur_range, satx, satv = orbit.orbitrangetime(
+                xyz, tt, xx, vv, tline0, satx0, satv0
+            )
+            if not isnan(tline):
+                tline0, satx0, satv0 = tline, satx, satv
+            if tline < t_start or tline > t_end:
+                continue
+            if cur_range < r_near or cur_range > r_far:
+                continue
+
+            az_idx = (tline - t_start) * inv_pri
+            rg_idx = (cur_range - r_near) * inv_delta_r
+            slc_interp = numba.complex64(interp(slc, az_idx, rg_idx))
+            # add the phase compensation for range (see `get_phase_lut`)
+            rg_floor = int(floor(rg_idx))
+            frac_phase = bin_phase * (rg_idx - rg_floor)
+            frac_phase = numba.float32(frac_phase - 2 * pi * floor(frac_phase / (2 * pi)))
+            # Keep the phasor math in complex64 (the default SLC dtype)
+            frac_phasor = numba.complex64(complex(cos(frac_phase), sin(frac_phase)))
+            out[i, j] = slc_interp * (frac_phasor * phase_lut[rg_floor])
 
 
 def geocode_cpu(
@@ -281,55 +410,136 @@ def geocode_cpu(
     r_near,
     r_far,
     delta_r,
+    block_rows=256,
 ):
-    # Storing temporary output as a memory map
-    folder = "./joblib_memmap"
-    try:
-        os.mkdir(folder)
-    except FileExistsError:
-        pass
-    tmp_slc = os.path.join(folder, "tmp.slc")
-    log.info("Dumping SLC to %s", tmp_slc)
-    slc.tofile(tmp_slc)
-    log.info("Memmapping SLC and DEM")
-    slc = np.memmap(tmp_slc, dtype=slc.dtype, shape=slc.shape, mode="r")
     dem = np.memmap(
         demfile, dtype=np.int16, shape=(len(lat_arr), len(lon_arr)), mode="r"
     )
-
-    output_filename_memmap = os.path.join(folder, "output_memmap")
-    # memmap for shared writing
-    out = np.memmap(
-        output_filename_memmap, dtype=slc.dtype, shape=dem.shape, mode="w+"
-    )
-
-    # Process one row at a time in parallel
-    par = Parallel(n_jobs=min(os.cpu_count(), 20))
-    par(
-        delayed(_geocode_cpu_row)(
-            i,
+    out = np.zeros(dem.shape, dtype=slc.dtype)
+    phase_lut = get_phase_lut(lam, r_near, delta_r, slc.shape[1])
+    bin_phase = 4.0 * pi * delta_r / lam
+    sin_lon, cos_lon = np.sin(lon_arr), np.cos(lon_arr)
+
+    # Process `block_rows` rows at a time (only that much of the DEM is read in),
+    # each block's rows in parallel
+    nrows = dem.shape[0]
+    for row_start in range(0, nrows, block_rows):
+        row_end = min(row_start + block_rows, nrows)
+        log.info("Processing rows %s to %s / %s", row_start, row_end, nrows)
+        _geocode_cpu_rows(
             slc,
-            dem,
-            lat_arr,
-            lon_arr,
-            lam,
+            np.asarray(dem[row_start:row_end]),
+            lat_arr[row_start:row_end],
+            sin_lon,
+            cos_lon,
             tt,
             xx,
             vv,
+            bin_phase,
             t_start,
             t_end,
             pri,
             r_near,
             r_far,
             delta_r,
-            out,
+            phase_lut,
+            out[row_start:row_end],
         )
-        # for i in range(1000)
-        for i in range(dem.shape[0])
-    )
-    # out = np.vstack(rows)
-    try:
-        shutil.rmtree(folder)
-    except:  # noqa
-        log.warning("Could not clean-up automatically.")
+    return out
+
+
+def geocode_gpu_blocks(
+    slc,
+    demfile,
+    lat_arr,
+    lon_arr,
+    lam,
+    tt,
+    xx,
+    vv,
+    t_start,
+    t_end,
+    pri,
+    r_near,
+    r_far,
+    delta_r,
+    block_rows=1024,
+    num_streams=2,
+):
+    """Run `geocode_gpu` over blocks of `block_rows` DEM rows
+
+    The SLC and orbit are copied to the GPU once. Each DEM block's copy in,
+    kernel, and copy out are queued on one of `num_streams` CUDA streams, so
+    transfers for one block overlap with the kernel for another.
+    """
+    log.info("Loading DEM:")
+    dem = utils.load_dem(demfile)
+    log.info("dem.shape = %s", dem.shape)
+    nrows, ncols = dem.shape
+
+    # x is the DEM column (the fast axis), so each warp covers 32 adjacent
+    # pixels of one row for coalesced DEM reads/output writes
+    threadsperblock = (32, 8)
+    blockspergrid_x = ceil(ncols / threadsperblock[0])
+    log.info("Geocoding and phase compensating SLC on GPU")
+    log.info("threads per block = (%s, %s)", *threadsperblock)
+
+    # Trig for the ECEF conversion: lat only varies by row, lon by column
+    sin_lat = np.sin(lat_arr)
+    cos_lat = np.cos(lat_arr)
+    rad_earth = EARTH_SMA / np.sqrt(1.0 - EARTH_E2 * sin_lat ** 2)
+
+    # Used by every block: copy over once
+    d_slc = cuda.to_device(slc)
+    d_sin_lon = cuda.to_device(np.sin(lon_arr))
+    d_cos_lon = cuda.to_device(np.cos(lon_arr))
+    d_tt = cuda.to_device(tt)
+    d_xx = cuda.to_device(xx)
+    d_vv = cuda.to_device(vv)
+    d_phase_lut = cuda.to_device(get_phase_lut(lam, r_near, delta_r, slc.shape[1]))
+    # Satellite state just outside the first/last pulse (see `outside_pulses`)
+    satx_start, satv_start = orbit.intp_orbit(tt, xx, vv, t_start - pri)
+    satx_end, satv_end = orbit.intp_orbit(tt, xx, vv, t_end + pri)
+    pulse_states = (satx_start, satv_start, satx_end, satv_end)
+
+    out = np.empty(dem.shape, dtype=slc.dtype)
+    streams = [cuda.stream() for _ in range(num_streams)]
+    # Page-locked host memory, so the copies can run asynchronously
+    with cuda.pinned(dem), cuda.pinned(out):
+        for block_idx, row_start in enumerate(range(0, nrows, block_rows)):
+            row_end = min(row_start + block_rows, nrows)
+            log.info("Processing rows %s to %s / %s", row_start, row_end, nrows)
+            stream = streams[block_idx % num_streams]
+            rows = slice(row_start, row_end)
+            d_out = cuda.device_array(
+                (row_end - row_start, ncols), dtype=slc.dtype, stream=stream
+            )
+            blockspergrid = (
+                blockspergrid_x,
+                ceil((row_end - row_start) / threadsperblock[1]),
+            )
+            geocode_gpu[blockspergrid, threadsperblock, stream](
+                d_slc,
+                cuda.to_device(dem[rows], stream=stream),
+                cuda.to_device(rad_earth[rows], stream=stream),
+                cuda.to_device(sin_lat[rows], stream=stream),
+                cuda.to_device(cos_lat[rows], stream=stream),
+                d_sin_lon,
+                d_cos_lon,
+                4.0 * pi * delta_r / lam,
+                d_tt,
+                d_xx,
+                d_vv,
+                t_start,
+                t_end,
+                1.0 / pri,
+                r_near,
+                r_far,
+                1.0 / delta_r,
+                pulse_states,
+                d_phase_lut,
+                d_out,
+            )
+            d_out.copy_to_host(out[rows], stream=stream)
+        cuda.synchronize()
     return out
@@ -5,12 +5,12 @@ from math import sin, cos, sqrt
 from numba import njit
 
 
-@njit(nogil=True)
+@njit(nogil=True, cache=True)
 def dot(vec1, vec2):
     return vec1[0] * vec2[0] + vec1[1] * vec2[1] + vec1[2] * vec2[2]
 
 
-@njit(nogil=True)
+@njit(nogil=True, cache=True)
 def orbitrangetime(
     xyz, tt, xx, vv, tline0=None, satx0=None, satv0=None, tol=5e-9, max_iter=100
 ):
@@ -18,10 +18,10 @@ def orbitrangetime(
     corresponding to `xyz`
 
     Args:
-        xyz (ndarray): 3-vector for ground point (in ECEF)
+        xyz (tuple or ndarray): 3-vector for ground point (in ECEF)
         tt (ndarray): vector of orbit pulse times
-        xx (ndarray): 2D vector, each row is (x, y, z) orbit position
-        vv (ndarray): 2D vector, each row is (vx, vy, vz) orbit velocity
+        xx (ndarray): 2D array, shape (3, N): rows are x, y, z orbit positions
+        vv (ndarray): 2D array, shape (3, N): rows are vx, vy, vz orbit velocities
         tline0 (float): initial guess for time iteration
         satx0 (ndarray): initial guess for satellite position iteration
         satv0 (ndarray): initial guess for satellite velocity iteration
@@ -30,27 +30,33 @@ def orbitrangetime(
 
     Returns:
         tline (float): zero doppler time for `xyz`
-        dr (ndarray): the relative 3-vector pointing from satellite to ground point
+        r (float): range from satellite to ground point
+        satx (tuple): satellite position at `tline`
+        satv (tuple): satellite velocity at `tline`
 
+    `tline`, `satx`, `satv` can be passed back as the starting guess for a
+    nearby ground point, which then converges in fewer iterations.
     """
     n = len(tt)
     if tline0 is None:
         tline0 = tt[n // 2]
+    # starting state, kept as (x, y, z) tuples so nothing is allocated per iteration
     if satx0 is None:
-        satx0 = xx[n // 2]
+        satx = (xx[0, n // 2], xx[1, n // 2], xx[2, n // 2])
+    else:
+        satx = (satx0[0], satx0[1], satx0[2])
     if satv0 is None:
-        satv0 = vv[n // 2]
-    # starting state
+        satv = (vv[0, n // 2], vv[1, n // 2], vv[2, n // 2])
+    else:
+        satv = (satv0[0], satv0[1], satv0[2])
     tline = tline0
-    satx = satx0
-    satv = satv0
 
     idx = 1
     tprev = tline + 1  # Need starting guess
     while abs(tline - tprev) > tol and idx < max_iter:
         tprev = tline
 
-        dr = xyz - satx
+        dr = (xyz[0] - satx[0], xyz[1] - satx[1], xyz[2] - satx[2])
 
         fn = dot(dr, satv)
         fnprime = -dot(satv, satv)
@@ -61,25 +67,19 @@ def orbitrangetime(
 
         idx += 1
 
-    dr = xyz - satx
+    dr = (xyz[0] - satx[0], xyz[1] - satx[1], xyz[2] - satx[2])
+    r = sqrt(dot(dr, dr))
 
-    return tline, dr  # r
+    return tline, r, satx, satv
 
 
-@njit(nogil=True)
+@njit(nogil=True, cache=True)
 def intp_orbit(tt, xx, vv, t):
     # if np.isposinf(t) or np.isneginf(t) or np.isnan(t):
     #     return None, None
 
     n = len(tt)
-    ilocation = 0
-    min_delta_t = 1.0e10
-    # find the location of the sampling time that is closest to t
-    for i in range(n):
-        delta_t = abs(t - tt[i])
-        if delta_t < min_delta_t:
-            min_delta_t = delta_t
-            ilocation = i
+    ilocation = _nearest_time_index(tt, t)
     # Four points are needed for the Hermite interpolation
     # ilocation = np.clip(ilocation, 1, n - 4)
     if ilocation < 1:
@@ -89,82 +89,149 @@ def intp_orbit(tt, xx, vv, t):
 
     satx, satv = orbithermite(
         tt[ilocation : ilocation + 4],
-        xx[ilocation : ilocation + 4],
-        vv[ilocation : ilocation + 4],
+        xx[:, ilocation : ilocation + 4],
+        vv[:, ilocation : ilocation + 4],
         t,
     )
     return satx, satv
 
 
-@njit(nogil=True)
+@njit(nogil=True, cache=True)
+def _nearest_time_index(tt, t):
+    """Index of the sample in the (increasing) times `tt` closest to `t`
+
+    Orbit samples are evenly spaced, so the index is first guessed directly,
+    then stepped to the true nearest sample (for uneven spacing).
+    """
+    n = len(tt)
+    guess = (t - tt[0]) * (n - 1) / (tt[n - 1] - tt[0])
+    # Clip before converting: `not >=` also catches a nan time
+    if not guess >= 0:
+        idx = 0
+    elif guess > n - 1:
+        idx = n - 1
+    else:
+        idx = int(guess + 0.5)
+    # Ties go to the earlier sample
+    while idx > 0 and abs(t - tt[idx - 1]) <= abs(t - tt[idx]):
+        idx -= 1
+    while idx < n - 1 and abs(t - tt[idx + 1]) < abs(t - tt[idx]):
+        idx += 1
+    return idx
+
+
+# fastmath without "nnan"/"ninf": a NaN time must still give a NaN orbit,
+# which the zero-doppler Newton solves (CPU and GPU) check to stop on
+HERMITE_FASTMATH = {"contract", "arcp", "reassoc"}
+
+
+@njit(nogil=True, fastmath=HERMITE_FASTMATH, inline="always", cache=True)
+def _hermite_weights(dt_i, dt_j, dt_k, dt_m, d_ij, d_ik, d_im):
+    """Hermite basis values at `t` for the sample i, given the other three j, k, m
+
+    Args:
+        dt_i, dt_j, dt_k, dt_m: t - tt[i], t - tt[j], ...
+        d_ij, d_ik, d_im: 1 / (tt[i] - tt[j]), ...
+
+    Returns:
+        alpha(t), beta(t), and their derivatives alpha'(t), beta'(t)
+    """
+    q_j = dt_j * d_ij
+    q_k = dt_k * d_ik
+    q_m = dt_m * d_im
+    # Lagrange basis polynomial, its derivative at t, and its derivative at tt[i]
+    li = q_j * q_k * q_m
+    hdot = d_ij * q_k * q_m + d_ik * q_j * q_m + d_im * q_j * q_k
+    dl = d_ij + d_ik + d_im
+
+    l2 = li * li
+    a = (1 - 2 * dt_i * dl) * l2
+    b = dt_i * l2
+    a2 = -2 * dl * l2 + (1 - 2 * dt_i * dl) * li * 2 * hdot
+    b2 = l2 + dt_i * li * 2 * hdot
+    return a, b, a2, b2
+
+
+@njit(nogil=True, fastmath=HERMITE_FASTMATH, cache=True)
 def orbithermite(tt, xx, vv, t):
     """orbithermite - hermite polynomial interpolation of orbits
 
+    Written out for the 4 points used, with all intermediate values as scalars
+
     Args:
         tt - 4-vector of times for each of the above data points
-        xx - 3x4 matrix of positions at four times
-        xv - 3x4 matrix of velocities
+        xx - 3x4 matrix of positions at four times (one row per component)
+        xv - 3x4 matrix of velocities (one row per component)
         t - time to interpolate orbit to
 
     Outputs
-        xout: length 3 ndarray, position at time `t`
-        vout: length 3 ndarray, velocity at time `t`
+        xout: (x, y, z) tuple, position at time `t`
+        vout: (vx, vy, vz) tuple, velocity at time `t`
     """
-    n = len(tt)
-    # Lagrange basis polynomials
-    li = np.ones(n)
-    # basis polynomials alpha(t)
-    a = np.zeros(n)
-    # basis polynomials beta(t)
-    b = np.zeros(n)
-    # derivative of alpha(t)
-    a2 = np.zeros(n)
-    # derivative of beta(t)
-    b2 = np.zeros(n)
-    for i in range(n):
-        dl = 0.0  # derivative of Lagrange basis at tt[i]
-        hdot = 0.0  # derivative of Lagrange basis at t
-        for j in range(n):
-            if i == j:
-                continue
-            dl = dl + 1.0 / (tt[i] - tt[j])
-            li[i] = li[i] * (t - tt[j]) / (tt[i] - tt[j])
-            p = 1.0 / (tt[i] - tt[j])
-            for k in range(n):
-                if k == i or k == j:
-                    continue
-                p = p * (t - tt[k]) / (tt[i] - tt[k])
-            hdot = hdot + p
-        l2 = li[i] * li[i]
-        a[i] = (1 - 2 * (t - tt[i]) * dl) * l2
-        b[i] = (t - tt[i]) * l2
-        a2[i] = -2 * dl * l2 + (1 - 2 * (t - tt[i]) * dl) * li[i] * 2 * hdot
-        b2[i] = l2 + (t - tt[i]) * li[i] * 2 * hdot
-
-    xout = np.zeros(3)
-    vout = np.zeros(3)
-    for j in range(3):
-        xout[j] = 0
-        vout[j] = 0
-        for i in range(n):
-            xout[j] += a[i] * xx[i][j] + b[i] * vv[i][j]
-            vout[j] += a2[i] * xx[i][j] + b2[i] * vv[i][j]
-    return xout, vout
-
-
-@njit(nogil=True)
+    dt0 = t - tt[0]
+    dt1 = t - tt[1]
+    dt2 = t - tt[2]
+    dt3 = t - tt[3]
+    # Reciprocal time differences: d_ji = -d_ij
+    d01 = 1.0 / (tt[0] - tt[1])
+    d02 = 1.0 / (tt[0] - tt[2])
+    d03 = 1.0 / (tt[0] - tt[3])
+    d12 = 1.0 / (tt[1] - tt[2])
+    d13 = 1.0 / (tt[1] - tt[3])
+    d23 = 1.0 / (tt[2] - tt[3])
+
+    a0, b0, a20, b20 = _hermite_weights(dt0, dt1, dt2, dt3, d01, d02, d03)
+    a1, b1, a21, b21 = _hermite_weights(dt1, dt0, dt2, dt3, -d01, d12, d13)
+    a2, b2, a22, b22 = _hermite_weights(dt2, dt0, dt1, dt3, -d02, -d12, d23)
+    a3, b3, a23, b23 = _hermite_weights(dt3, dt0, dt1, dt2, -d03, -d13, -d23)
+
+    x0 = a0 * xx[0, 0] + a1 * xx[0, 1] + a2 * xx[0, 2] + a3 * xx[0, 3]
+    x0 += b0 * vv[0, 0] + b1 * vv[0, 1] + b2 * vv[0, 2] + b3 * vv[0, 3]
+    x1 = a0 * xx[1, 0] + a1 * xx[1, 1] + a2 * xx[1, 2] + a3 * xx[1, 3]
+    x1 += b0 * vv[1, 0] + b1 * vv[1, 1] + b2 * vv[1, 2] + b3 * vv[1, 3]
+    x2 = a0 * xx[2, 0] + a1 * xx[2, 1] + a2 * xx[2, 2] + a3 * xx[2, 3]
+    x2 += b0 * vv[2, 0] + b1 * vv[2, 1] + b2 * vv[2, 2] + b3 * vv[2, 3]
+
+    v0 = a20 * xx[0, 0] + a21 * xx[0, 1] + a22 * xx[0, 2] + a23 * xx[0, 3]
+    v0 += b20 * vv[0, 0] + b21 * vv[0, 1] + b22 * vv[0, 2] + b23 * vv[0, 3]
+    v1 = a20 * xx[1, 0] + a21 * xx[1, 1] + a22 * xx[1, 2] + a23 * xx[1, 3]
+    v1 += b20 * vv[1, 0] + b21 * vv[1, 1] + b22 * vv[1, 2] + b23 * vv[1, 3]
+    v2 = a20 * xx[2, 0] + a21 * xx[2, 1] + a22 * xx[2, 2] + a23 * xx[2, 3]
+    v2 += b20 * vv[2, 0] + b21 * vv[2, 1] + b22 * vv[2, 2] + b23 * vv[2, 3]
+    return (x0, x1, x2), (v0, v1, v2)
+
+
+@njit(nogil=True, cache=True)
 def llh_to_xyz(lat, lon, h):
-    """Lat, lon (in radians), height to ECEF X,Y,Z"""
-    rad_earth = EARTH_SMA / sqrt(1.0 - EARTH_E2 * sin(lat) ** 2)
+    """Lat, lon (in radians), height to ECEF (X, Y, Z) tuple"""
+    sin_lat = sin(lat)
+    return llh_to_xyz_trig(
+        earth_radius(sin_lat), sin_lat, cos(lat), sin(lon), cos(lon), h
+    )
+
 
-    xyz = np.zeros((3,), dtype=np.float64)
-    xyz[0] = (rad_earth + h) * cos(lat) * cos(lon)
-    xyz[1] = (rad_earth + h) * cos(lat) * sin(lon)
-    xyz[2] = (rad_earth * (1.0 - EARTH_E2) + h) * sin(lat)
-    return xyz
+@njit(nogil=True, cache=True)
+def earth_radius(sin_lat):
+    """Prime vertical radius of curvature at the latitude with sine `sin_lat`"""
+    return EARTH_SMA / sqrt(1.0 - EARTH_E2 * sin_lat ** 2)
+
+
+@njit(nogil=True, cache=True)
+def llh_to_xyz_trig(rad_earth, sin_lat, cos_lat, sin_lon, cos_lon, h):
+    """`llh_to_xyz` using precomputed trig values and `earth_radius`
+
+    For a grid, these only depend on the row (lat) or column (lon),
+    so they can be computed once per row/column rather than per pixel.
+    """
+    xy = (rad_earth + h) * cos_lat
+    return (
+        xy * cos_lon,
+        xy * sin_lon,
+        (rad_earth * (1.0 - EARTH_E2) + h) * sin_lat,
+    )
 
 
-@njit(nogil=True)
+@njit(nogil=True, cache=True)
 def xyz_to_llh_f(xyz):
     """Copy from fortran code"""
     r_a = EARTH_SMA
@@ -1,24 +1,22 @@
 import datetime
+import re
+
 from .constants import C
 from uaquery.logger import get_log
-from uaquery.parsers import Base
-
-log = get_log()
-
-try:
-    import h5py
-except ImportError:
-    log.info("Can't import h5py,", exc_info=True)
+from uaquery.parsers import Uavsar, UAVSAR_NAME_REGEX
 
+# Still importable from here, as they were defined in this module before
+from uaquery.parsers import (  # noqa: F401
+    REAL_POLS,
+    COMPLEX_POLS,
+    CROSS_POLARIZATIONS,
+    SINGLE_POLARIZATIONS,
+)
 
-# Filetype of real or complex depends on the polarization for .grd, .mlc
-REAL_POLS = ("HHHH", "HVHV", "VVVV")
-COMPLEX_POLS = ("HHHV", "HHVV", "HVVV")
-CROSS_POLARIZATIONS = REAL_POLS + COMPLEX_POLS
-SINGLE_POLARIZATIONS = ("HH", "HV", "VH", "VV")
+log = get_log()
 
 
-class UavsarHDF5(Base):
+class UavsarHDF5(Uavsar):
     """UAVSAR NISAR sample product data reference:
     https://uavsar.jpl.nasa.gov/science/documents/nisar-sample-products.html
 
@@ -42,19 +40,10 @@ class UavsarHDF5(Base):
 
     """
 
-    FILE_REGEX = (
-        r"(?P<target_site>[\w\d]{6})_"
-        # r"(?P<heading>\d{3})(?P<counter>\w+)_" # this is lineID
-        r"(?P<line_id>\d{5})_"
-        # r"(?P<year>\d{2})(?P<flight_number>\d{3})_" # this is FlightID
-        r"(?P<flight_id>\d{5})_"
-        r"(?P<data_take>\d{3})_"
-        r"(?P<date>\d{6})_"
-        r"(?P<band_squint_pol>\w{0,8})_"
-        r"(?P<xtalk>X|C)(?P<dither>[XGD])_"
-        r"(?P<nmode>\w{3,4})?_?"
-        r"(?P<version>\d{2})\.h5"
-    )
+    __slots__ = ("_hf",)
+
+    FILE_REGEX = UAVSAR_NAME_REGEX + r"(?P<version>\d{2})\.h5"
+    FILE_RE = re.compile(FILE_REGEX)
     TIME_FMT = "%y%m%d"
 
     SLC_GROUP = "/science/LSAR/SLC/"
@@ -62,6 +51,87 @@ class UavsarHDF5(Base):
     METADATA_GROUP = SLC_GROUP + "metadata/"
     CAL_GROUP = "/science/LSAR/SLC/metadata/calibrationInformation/"
     DT_FMT = "%Y-%m-%d %H:%M:%S"  # Used in attrs['units']: "seconds since ___"
+    # HDF5 raw data chunk cache (per dataset): big enough to hold the chunks
+    # of a block of SLC rows, so partial reads don't decompress chunks twice.
+    # Number of hash slots should be a prime, ~10-100x the chunks that fit
+    CHUNK_CACHE_BYTES = 256 * 2 ** 20
+    CHUNK_CACHE_SLOTS = 10007
+
+    def __init__(self, filename, verbose=False):
+        super(UavsarHDF5, self).__init__(filename, verbose=verbose)
+        self._hf = None  # File handle: opened on the first read, kept until `close`
+
+    def open(self):
+        """Open the HDF5 file for reading
+
+        Not needed before reading: the file is opened on first use and kept
+        open for later reads. Can also be used as a context manager to close
+        the file when done:
+        >>> with UavsarHDF5(fname) as uav:
+        ...     tt, xx, vv = uav.get_orbit()
+        """
+        if self._hf is None:
+            # Imported here so filename parsing doesn't pay for loading HDF5
+            import h5py
+
+            self._hf = h5py.File(
+                self.filename,
+                "r",
+                rdcc_nbytes=self.CHUNK_CACHE_BYTES,
+                rdcc_nslots=self.CHUNK_CACHE_SLOTS,
+            )
+        return self
+
+    def close(self):
+        if self._hf is not None:
+            self._hf.close()
+            self._hf = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _swath_path(self, frequency, name=None):
+        """Path to the group for one frequency, or to `name` within it"""
+        group_path = self.SWATH_GROUP + "frequency" + frequency
+        return group_path if name is None else group_path + "/" + name
+
+    @property
+    def _file(self):
+        """The open file handle (opens the file if needed)"""
+        return self.open()._hf
+
+    def preload_metadata(self, frequency="A"):
+        """Read all the geometry metadata needed for geocoding
+
+        Returns:
+            dict: `get_frequency_params` keys ("prf", "wavelength", "d_range",
+            "slant_ranges"), plus "orbit" (time, position, velocity) and
+            "zero_doppler_times"
+        """
+        metadata = self.get_frequency_params(frequency)
+        metadata["orbit"] = self.get_orbit()
+        metadata["zero_doppler_times"] = self.get_zero_doppler_times()
+        return metadata
+
+    def get_frequency_params(self, frequency="A"):
+        """Read the per-frequency swath parameters in one visit to the group
+
+        Returns:
+            dict: keys "prf", "wavelength", "d_range", "slant_ranges"
+        """
+        group_path = self._swath_path(frequency)
+        if self.verbose:
+            log.info("Getting frequency parameters from %s:%s", self.filename, group_path)
+        group = self._file[group_path]
+        return {
+            "prf": group["nominalAcquisitionPRF"][()],
+            "wavelength": C / group["processedCenterFrequency"][()],
+            "d_range": group["slantRangeSpacing"][()],
+            "slant_ranges": group["slantRange"][()],
+        }
 
     def get_slc(
         self,
@@ -69,39 +139,68 @@ class UavsarHDF5(Base):
         polarization="HH",
         output=None,
         dtype="complex64",
+        chunk_bytes=128 * 2 ** 20,
+        row_start=0,
+        row_end=None,
     ):
         """Extract the complex SLC image for one NISAR frequency/polarization
 
-        If `output` is given, will save to a binary SLC file"""
-        h5path = self.SWATH_GROUP + "frequency{}/{}".format(frequency, polarization)
+        If `output` is given, will save to a binary SLC file, reading and
+        writing about `chunk_bytes` of rows at a time.
+        Only rows `row_start:row_end` are read (default: all rows)"""
+        import numpy as np
+
+        h5path = self._swath_path(frequency, polarization)
         if self.verbose:
             log.info("Getting data from %s:%s", self.filename, h5path)
-        with h5py.File(self.filename, "r") as hf:
-            ds = hf[h5path]
-            with ds.astype(dtype):
-                if output:
-                    with open(output, "wb") as fout:
-                        ds[()].tofile(fout)
-                else:
-                    return ds[()]
-
-    def _get_data(self, h5path):
+        ds = self._file[h5path]
+        first_row, last_row, _ = slice(row_start, row_end).indices(ds.shape[0])
+        last_row = max(first_row, last_row)
+        if not output:
+            # read_direct converts to `dtype` as it reads
+            slc = np.empty((last_row - first_row, ds.shape[1]), dtype=dtype)
+            ds.read_direct(slc, np.s_[first_row:last_row])
+            return slc
+
+        rows, cols = last_row - first_row, ds.shape[1]
+        chunk_rows = max(1, chunk_bytes // (cols * np.dtype(dtype).itemsize))
+        if ds.chunks and chunk_rows > ds.chunks[0]:
+            # Read whole HDF5 chunks so none get decompressed twice
+            chunk_rows -= chunk_rows % ds.chunks[0]
+        buf = np.empty((max(1, min(chunk_rows, rows)), cols), dtype=dtype)
+        with open(output, "wb") as fout:
+            for chunk_start in range(first_row, last_row, chunk_rows):
+                chunk_end = min(chunk_start + chunk_rows, last_row)
+                nrows = chunk_end - chunk_start
+                ds.read_direct(buf, np.s_[chunk_start:chunk_end], np.s_[:nrows])
+                buf[:nrows].tofile(fout)
+
+    def _get_data(self, h5path, out=None):
+        """Read the dataset at `h5path`
+
+        If `out` is given, reads directly into that (preallocated) array,
+        so that buffers can be reused across files with the same shapes"""
+        import numpy as np
+
         if self.verbose:
             log.info("Getting data from %s:%s", self.filename, h5path)
-        with h5py.File(self.filename, "r") as hf:
-            return hf[h5path][()]
+        ds = self._file[h5path]
+        if out is None:
+            # Scalars and strings: nothing to gain from read_direct
+            if not ds.shape or ds.dtype.kind == "O":
+                return ds[()]
+            out = np.empty(ds.shape, dtype=ds.dtype)
+        ds.read_direct(out)
+        return out
 
     def _get_attrs(self, h5path):
         if self.verbose:
             log.info("Getting attributes from %s:%s", self.filename, h5path)
-        with h5py.File(self.filename, "r") as hf:
-            return dict(hf[h5path].attrs)
+        return dict(self._file[h5path].attrs)
 
     def get_prf(self, frequency="A"):
         """Nominal pulse repitition frequency"""
-        h5path = self.SWATH_GROUP + "frequency{}/{}".format(
-            frequency, "nominalAcquisitionPRF"
-        )
+        h5path = self._swath_path(frequency, "nominalAcquisitionPRF")
         return self._get_data(h5path)
 
     # Another way for 1/prf... seems to be equivalent
@@ -128,13 +227,30 @@ class UavsarHDF5(Base):
         h5path = (
             self.METADATA_GROUP + "processingInformation/parameters/effectiveVelocity"
         )
-        return self._get_data(h5path).mean() if not attrs else self._get_attrs(h5path)
+        if attrs:
+            return self._get_attrs(h5path)
+        return self._get_mean(h5path)
+
+    def _get_mean(self, h5path, block_rows=1024):
+        """Mean of a dataset, read `block_rows` rows at a time into one buffer"""
+        import numpy as np
+
+        ds = self._file[h5path]
+        if ds.ndim < 2:
+            return self._get_data(h5path).mean()
+        rows = ds.shape[0]
+        buf = np.empty((min(block_rows, rows),) + ds.shape[1:], dtype=ds.dtype)
+        total = 0.0
+        for row_start in range(0, rows, block_rows):
+            row_end = min(row_start + block_rows, rows)
+            nrows = row_end - row_start
+            ds.read_direct(buf, np.s_[row_start:row_end], np.s_[:nrows])
+            total += buf[:nrows].sum(dtype=np.float64)
+        return total / ds.size
 
     def get_wavelength(self, frequency="A", attrs=False):
         """Wave wavelength in meters from `hdf5_file`"""
-        h5path = self.SWATH_GROUP + "frequency{}/{}".format(
-            frequency, "processedCenterFrequency"
-        )
+        h5path = self._swath_path(frequency, "processedCenterFrequency")
         if attrs:
             return self._get_attrs(h5path)
         center_freq = self._get_data(h5path)
@@ -142,14 +258,12 @@ class UavsarHDF5(Base):
 
     def get_d_range(self, frequency="A", attrs=False):
         """Slant range spacing"""
-        h5path = self.SWATH_GROUP + "frequency{}/{}".format(
-            frequency, "slantRangeSpacing"
-        )
+        h5path = self._swath_path(frequency, "slantRangeSpacing")
         return self._get_data(h5path) if not attrs else self._get_attrs(h5path)
 
     def get_slant_ranges(self, frequency="A", attrs=False):
         """Array of ranges to each slant range bin"""
-        h5path = self.SWATH_GROUP + "frequency{}/{}".format(frequency, "slantRange")
+        h5path = self._swath_path(frequency, "slantRange")
         return self._get_data(h5path) if not attrs else self._get_attrs(h5path)
 
     def get_orbit(self, attrs=False, as_datetime=False):
@@ -181,8 +295,11 @@ class UavsarHDF5(Base):
         ref_time = self._get_ref_dt(h5path)
         # NOTE: it gives 10 decimals of precision after the second, but numpy picosecond
         # only allows [1969, 1970] year ranges. So truncate the 10th decimal
-        ns_offsets = (1e9 * second_offsets).astype("timedelta64[ns]")
-        return np.datetime64(ref_time) + ns_offsets
+        # Scale straight into int64 nanoseconds (truncating, like `astype`), with
+        # no full-size float temporary
+        ns_offsets = np.empty(second_offsets.shape, dtype=np.int64)
+        np.multiply(second_offsets, 1e9, out=ns_offsets, casting="unsafe")
+        return np.datetime64(ref_time) + ns_offsets.view("timedelta64[ns]")
 
     def _get_ref_dt(self, h5path):
         """Parse the reference time from some HDF5 dataset"""
@@ -208,18 +325,33 @@ class UavsarHDF5(Base):
 
         if slc is None:
             slc = self.get_slc()
-        cal_img = self._get_cal_slc(to=to, order=order)
-        return np.sqrt(cal_img[row_start:row_end]) * slc[row_start:row_end]
+        if order == 1:
+            from . import utils
+
+            # Interpolate the LUT, take sqrt and multiply in one pass over the SLC
+            lut, t_coord, r_coord = self._get_cal_lut_coords(to=to)
+            return utils.apply_cal_lut(
+                slc[row_start:row_end], lut, t_coord[row_start:row_end], r_coord
+            )
+        cal_img = self._get_cal_slc(to=to, order=order)[row_start:row_end]
+        # `cal_img` is a new array, so take the sqrt in place
+        np.sqrt(cal_img, out=cal_img)
+        # Match the `order=1` output, which keeps the SLC's dtype
+        return (cal_img * slc[row_start:row_end]).astype(slc.dtype, copy=False)
+
+    def get_cal_gamma0(self, attrs=False, out=None):
+        """Get the array of gamma0 calibration values
 
-    def get_cal_gamma0(self, attrs=False):
-        """Get the array of gamma0 calibration values"""
+        `out` is an optional preallocated array to read into"""
         h5path = self.CAL_GROUP + "geometry/gamma0"
-        return self._get_data(h5path) if not attrs else self._get_attrs(h5path)
+        return self._get_data(h5path, out=out) if not attrs else self._get_attrs(h5path)
+
+    def get_cal_beta0(self, attrs=False, out=None):
+        """Get the array of beta0 calibration values
 
-    def get_cal_beta0(self, attrs=False):
-        """Get the array of beta0 calibration values"""
+        `out` is an optional preallocated array to read into"""
         h5path = self.CAL_GROUP + "geometry/beta0"
-        return self._get_data(h5path) if not attrs else self._get_attrs(h5path)
+        return self._get_data(h5path, out=out) if not attrs else self._get_attrs(h5path)
 
     def _get_cal_slc(self, to="gamma0", order=1):
         """Compute the gamma0/beta0 calibration values interpolated
@@ -227,14 +359,19 @@ class UavsarHDF5(Base):
         TODO: Do i need to try to adjust the start/stop times based on 
         how other SLCs are coregistered?
         """
+        if order == 1:
+            from . import utils
+
+            # Bilinear on the LUT grid doesn't need a spline fit: sample
+            # directly at the fractional LUT indices of the SLC times/ranges
+            interp_vals, t_coord, r_coord = self._get_cal_lut_coords(to=to)
+            return utils.interp_cal_lut(interp_vals, t_coord, r_coord)
+
         from scipy.interpolate import RectBivariateSpline
 
         slant_ranges_cal = self._get_data(self.CAL_GROUP + "slantRange")
         ztd_cal = self._get_data(self.CAL_GROUP + "zeroDopplerTime")
-        if to == "gamma0":
-            interp_vals = self.get_cal_gamma0()
-        elif to == "beta0":
-            interp_vals = self.get_cal_beta0()
+        interp_vals = self._get_cal_lut(to=to)
 
         # TODO: get this for coregistered stuff....
         slant_ranges_slc = self.get_slant_ranges()
@@ -245,18 +382,36 @@ class UavsarHDF5(Base):
         )
         return interpolator(ztd_slc, slant_ranges_slc)
 
-    @property
-    def line_id(self):
-        return self._get_field("line_id")
+    def _get_cal_lut(self, to="gamma0"):
+        if to == "gamma0":
+            return self.get_cal_gamma0()
+        elif to == "beta0":
+            return self.get_cal_beta0()
+        raise ValueError("`to` must be 'gamma0' or 'beta0': got {}".format(to))
 
-    @property
-    def flight_id(self):
-        return self._get_field("flight_id")
+    def _get_cal_lut_coords(self, to="gamma0"):
+        """Get the calibration LUT and the fractional (row, col) LUT indices
+        of each SLC zero doppler time/ slant range
 
-    @property
-    def data_take(self):
-        return self._get_field("data_take")
+        Indices are clamped to the LUT edges.
 
-    @property
-    def date(self):
-        return self._get_field("date")
+        Returns:
+            lut (ndarray): 2D gamma0/beta0 LUT
+            t_coord (ndarray): fractional LUT row for each SLC row
+            r_coord (ndarray): fractional LUT column for each SLC column
+        """
+        import numpy as np
+
+        slant_ranges_cal = self._get_data(self.CAL_GROUP + "slantRange")
+        ztd_cal = self._get_data(self.CAL_GROUP + "zeroDopplerTime")
+        lut = self._get_cal_lut(to=to)
+
+        # TODO: get this for coregistered stuff....
+        slant_ranges_slc = self.get_slant_ranges()
+        ztd_slc = self.get_zero_doppler_times()
+
+        t_coord = np.interp(ztd_slc, ztd_cal, np.arange(len(ztd_cal)))
+        r_coord = np.interp(
+            slant_ranges_slc, slant_ranges_cal, np.arange(len(slant_ranges_cal))
+        )
+        return lut, t_coord, r_coord
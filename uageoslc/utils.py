@@ -1,5 +1,8 @@
 import numpy as np
 import collections
+from math import floor, sqrt
+
+from numba import njit, prange
 
 RSC_KEY_TYPES = [
     ("width", int),
@@ -14,6 +17,8 @@ RSC_KEY_TYPES = [
     ("z_scale", int),
     ("projection", str),
 ]
+# Keys as written in the .rsc file -> (output key, type to cast to)
+RSC_KEY_LOOKUP = {field.upper(): (field, num_type) for field, num_type in RSC_KEY_TYPES}
 
 
 def load_rsc(filename, **kwargs):
@@ -50,10 +55,12 @@ def load_rsc(filename, **kwargs):
         "{}.rsc".format(filename) if not filename.endswith(".rsc") else filename
     )
     with open(rsc_filename, "r") as f:
-        for line in f.readlines():
-            for field, num_type in RSC_KEY_TYPES:
-                if line.startswith(field.upper()):
-                    output_data[field] = num_type(line.split()[1])
+        for line in f:
+            parts = line.split()
+            if not parts or parts[0] not in RSC_KEY_LOOKUP:
+                continue
+            field, num_type = RSC_KEY_LOOKUP[parts[0]]
+            output_data[field] = num_type(parts[1])
 
     return output_data
 
@@ -91,8 +98,9 @@ def _rsc_to_grid(
 ):
     rows = rows or file_length
     cols = cols or width
-    lon_arr = np.linspace(x_first, x_first + (cols - 1) * x_step, cols)
-    lat_arr = np.linspace(y_first, y_first + (rows - 1) * y_step, rows)
+    # Kept as float64: float32 would round degrees to ~1 meter on the ground
+    lon_arr = x_first + x_step * np.arange(cols)
+    lat_arr = y_first + y_step * np.arange(rows)
     return lon_arr, lat_arr
 
 
@@ -125,15 +133,88 @@ def take_looks(arr, row_looks, col_looks, separate_complex=False, **kwargs):
     new_rows = rows // row_looks
     new_cols = cols // col_looks
 
-    row_cutoff = rows % row_looks
-    col_cutoff = cols % col_looks
+    # For taking the mean, treat integers (and bools) as floats
+    if not np.issubdtype(arr.dtype, np.inexact):
+        out_dtype = np.float64
+    else:
+        out_dtype = arr.dtype
+    out = np.zeros((new_rows, new_cols), dtype=out_dtype)
+    # Rows/cols past the last full block are never read, so they're cut off
+    _take_looks(arr, row_looks, col_looks, out)
+    return out
+
+
+@njit(nogil=True, parallel=True, cache=True)
+def _take_looks(arr, row_looks, col_looks, out):
+    """Average each (row_looks, col_looks) block of `arr` into `out`
 
-    if row_cutoff != 0:
-        arr = arr[:-row_cutoff, :]
-    if col_cutoff != 0:
-        arr = arr[:, :-col_cutoff]
-    # For taking the mean, treat integers as floats
-    if np.issubdtype(arr.dtype, np.integer):
-        arr = arr.astype("float")
+    Each output row is summed by one thread, reading full rows of `arr`
+    in order, without the reshaped copy a numpy `mean` would need.
+    """
+    new_rows, new_cols = out.shape
+    num_looks = row_looks * col_looks
+    for i in prange(new_rows):
+        for di in range(row_looks):
+            row = i * row_looks + di
+            for j in range(new_cols):
+                for dj in range(col_looks):
+                    out[i, j] += arr[row, j * col_looks + dj]
+        for j in range(new_cols):
+            out[i, j] /= num_looks
+
+
+@njit(nogil=True, parallel=True, cache=True)
+def apply_cal_lut(slc, lut, t_coord, r_coord):
+    """Multiply `slc` by the sqrt of a calibration LUT, bilinearly interpolated
+
+    Args:
+        slc (ndarray): 2D complex image
+        lut (ndarray): 2D calibration LUT (e.g. gamma0, in power units)
+        t_coord (ndarray): fractional LUT row for each row of `slc`
+        r_coord (ndarray): fractional LUT column for each column of `slc`
 
-    return np.mean(arr.reshape(new_rows, row_looks, new_cols, col_looks), axis=(3, 1))
\ No newline at end of file
+    Returns:
+        ndarray: calibrated image, same size and dtype as `slc`
+    """
+    nrows, ncols = slc.shape
+    lut_rows = lut.shape[0]
+    out = np.empty(slc.shape, dtype=slc.dtype)
+    for i in prange(nrows):
+        t_low = min(int(floor(t_coord[i])), lut_rows - 1)
+        t_high = min(t_low + 1, lut_rows - 1)
+        pct_t = t_coord[i] - t_low
+        for j in range(ncols):
+            cal = _interp_lut_point(lut, t_low, t_high, pct_t, r_coord[j])
+            out[i, j] = sqrt(cal) * slc[i, j]
+    return out
+
+
+@njit(nogil=True, parallel=True, cache=True)
+def interp_cal_lut(lut, t_coord, r_coord):
+    """Bilinearly interpolate a calibration LUT onto the grid of
+    (`t_coord`, `r_coord`) fractional LUT indices (as for `apply_cal_lut`)
+
+    Returns:
+        ndarray: shape (len(t_coord), len(r_coord)), same dtype as `lut`
+    """
+    lut_rows = lut.shape[0]
+    out = np.empty((len(t_coord), len(r_coord)), dtype=lut.dtype)
+    for i in prange(len(t_coord)):
+        t_low = min(int(floor(t_coord[i])), lut_rows - 1)
+        t_high = min(t_low + 1, lut_rows - 1)
+        pct_t = t_coord[i] - t_low
+        for j in range(len(r_coord)):
+            out[i, j] = _interp_lut_point(lut, t_low, t_high, pct_t, r_coord[j])
+    return out
+
+
+@njit(nogil=True, inline="always", cache=True)
+def _interp_lut_point(lut, t_low, t_high, pct_t, r):
+    """LUT value at fractional column `r`, between rows `t_low` and `t_high`"""
+    lut_cols = lut.shape[1]
+    r_low = min(int(floor(r)), lut_cols - 1)
+    r_high = min(r_low + 1, lut_cols - 1)
+    pct_r = r - r_low
+    cal_low = (1 - pct_r) * lut[t_low, r_low] + pct_r * lut[t_low, r_high]
+    cal_high = (1 - pct_r) * lut[t_high, r_low] + pct_r * lut[t_high, r_high]
+    return (1 - pct_t) * cal_low + pct_t * cal_high
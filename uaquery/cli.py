@@ -1,10 +1,16 @@
 #!/usr/bin/env python
 import argparse
+import re
 from datetime import datetime
 from . import query_uavsar
 from . import parsers
 from .logger import get_log
-from .query_uavsar import MODE_CHOICES, POLARIZATION_CHOICES, URL_FILE_DEFAULT, DATE_FMT
+from .query_uavsar import (
+    MODE_CHOICES,
+    POLARIZATION_CHOICES,
+    PRODUCT_LINKS_CACHE,
+    URL_FILE_DEFAULT,
+)
 
 log = get_log()
 
@@ -14,7 +20,8 @@ def cli():
     p.add_argument(
         "flight_line",
         type=int,
-        help="UAVSAR flight line",
+        nargs="+",
+        help="UAVSAR flight line(s). Several lines are searched in one run.",
     )
     p.add_argument(
         "--file-type",
@@ -65,6 +72,14 @@ def cli():
         default=URL_FILE_DEFAULT,
         help="File to save the URLs found for download (default=%(default)s)",
     )
+    p.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=(
+            "Search each product's download links again, instead of reusing "
+            "ones saved in the last week to {}".format(PRODUCT_LINKS_CACHE)
+        ),
+    )
     p.add_argument(
         "--quiet",
         action="store_true",
@@ -72,17 +87,23 @@ def cli():
     )
     args = p.parse_args()
     _check_valid_pol(args.pol, args.file_type)
+    if len(args.flight_line) > 1 and args.url_file != URL_FILE_DEFAULT:
+        p.error("--url-file can only be used when searching one flight line")
     args.verbose = not args.quiet
     log.info("Arguments for search:")
     log.info(vars(args))
 
-    if args.query_only:
-        log.info("Only finding URLs for download:")
-        url_list = query_uavsar.find_data_urls(**vars(args))
-        log.info("\n".join(url_list))
-    else:
-        log.info("Searching and downloading to " + args.out_dir)
-        query_uavsar.download(**vars(args))
+    # One process for all lines, so the connection pool and caches stay warm
+    kwargs = vars(args)
+    flight_lines = kwargs.pop("flight_line")
+    for flight_line in flight_lines:
+        if args.query_only:
+            log.info("Only finding URLs for download:")
+            url_list = query_uavsar.find_data_urls(flight_line, **kwargs)
+            log.info("\n".join(url_list))
+        else:
+            log.info("Searching and downloading to " + args.out_dir)
+            query_uavsar.download(flight_line, **kwargs)
 
 
 def _check_valid_pol(pol, file_type):
@@ -101,22 +122,27 @@ def _check_valid_pol(pol, file_type):
             )
 
 
+# (YYYY or yy), mm, dd, with optional "-", "_", or "/" separators
+DATE_RE = re.compile(r"(\d{4}|\d{2})[-_/]?(\d{2})[-_/]?(\d{2})")
+
+
 def _valid_date(arg_value):
     """Parse the date, making some guesses if they pass extra stuff
     Try and accept 2013-01-01, 13_01_01, 2013/01/01, 20130101, 130101"""
-    arg = arg_value.replace("_", "").replace("-", "").replace("/", "")
     err_msg = "Not a valid date: '{}'.".format(arg_value)
+    match = DATE_RE.fullmatch(arg_value)
+    if not match:
+        # Other cases don't match accepted format
+        raise argparse.ArgumentTypeError(err_msg)
+    year, month, day = (int(g) for g in match.groups())
+    if len(match.group(1)) == 2:
+        # Same century rule as strptime's "%y": 69-99 -> 1900s, 00-68 -> 2000s
+        year += 1900 if year >= 69 else 2000
     try:
-        if len(arg) == 8:  # YYYYmmdd:
-            return datetime.strptime(arg, "%Y%m%d")
-        elif len(arg) == 6:
-            return datetime.strptime(arg, DATE_FMT)
+        return datetime(year, month, day)
     except ValueError:
         raise argparse.ArgumentTypeError(err_msg)
 
-    # Other cases don't match accepted format
-    raise argparse.ArgumentTypeError(err_msg)
-
 
 if __name__ == "__main__":
     cli()
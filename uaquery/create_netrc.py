@@ -1,13 +1,7 @@
-from __future__ import print_function
 import os
 import netrc
 import getpass
 
-try:
-    input = raw_input  # Check for python 2
-except NameError:
-    pass
-
 NASAHOST = "urs.earthdata.nasa.gov"
 NETRC_FILE = "~/.netrc"
 
@@ -43,7 +37,7 @@ class Netrc(netrc.netrc):
         return repr(self)
 
 
-class ASFCredentials(object):
+class ASFCredentials:
     def has_nasa_netrc(self):
         try:
             n = self.get_netrc_file()
@@ -53,7 +47,7 @@ class ASFCredentials(object):
                 and n.authenticators(NASAHOST)[0]
                 and n.authenticators(NASAHOST)[2]
             )
-        except (OSError, IOError):
+        except OSError:
             return False
 
     def handle_credentials(self):
@@ -68,7 +62,7 @@ class ASFCredentials(object):
                 n = self.get_netrc_file()
                 n.hosts[NASAHOST] = (username, None, password)
                 outstring = str(n)
-            except (OSError, IOError):
+            except OSError:
                 # Otherwise, make a fresh one to save
                 outstring = self._nasa_netrc_entry(username, password)
 
@@ -1,15 +1,11 @@
 import re
-import sys
+from html import unescape
+from html.parser import HTMLParser
 
 from .logger import get_log
 
 log = get_log()
 
-if sys.version_info.major == 2:
-    from HTMLParser import HTMLParser
-else:
-    from html.parser import HTMLParser
-
 
 # Filetype of real or complex depends on the polarization for .grd, .mlc
 REAL_POLS = ("HHHH", "HVHV", "VVVV")
@@ -17,6 +13,34 @@ COMPLEX_POLS = ("HHHV", "HHVV", "HVVV")
 CROSS_POLARIZATIONS = REAL_POLS + COMPLEX_POLS
 SINGLE_POLARIZATIONS = ("HH", "HV", "VH", "VV")
 
+# Fields shared by all UAVSAR product names, up to the version number
+UAVSAR_NAME_REGEX = (
+    r"(?P<target_site>[\w\d]{6})_"
+    # r"(?P<heading>\d{3})(?P<counter>\w+)_" # this is lineID
+    r"(?P<line_id>\d{5})_"
+    # r"(?P<year>\d{2})(?P<flight_number>\d{3})_" # this is FlightID
+    r"(?P<flight_id>\d{5})_"
+    r"(?P<data_take>\d{3})_"
+    r"(?P<date>\d{6})_"
+    r"(?P<band_squint_pol>\w{0,8})_"
+    r"(?P<xtalk>X|C)(?P<dither>[XGD])_"
+    # (not \w, which would also take the "_" before the version)
+    r"(?P<nmode>[A-Za-z0-9]{3,4})?_?"
+)
+
+# Text of the tag marking a product as a NISAR-simulated version
+NISAR_TAG_TEXT = "#simulated-nisar #dithered"
+# Matches either the href of an <a> tag, or the NISAR tag text between tags.
+# Comments and <script>/<style> bodies are matched first (and skipped), since
+# `HTMLParser` never reports tags inside them.
+LINK_OR_NISAR_RE = re.compile(
+    r"(?P<skip><!--.*?(?:-->|\Z)|<(?P<cdata>script|style)\b.*?(?:</(?P=cdata)\s*>|\Z))"
+    r"|<a\s(?:[^>]*?\s)?href\s*=\s*"
+    r"""(?:"(?P<dq>[^"]*)"|'(?P<sq>[^']*)'|(?P<uq>[^\s"'>]+))"""
+    r"|>(?P<nisar_tag>" + re.escape(NISAR_TAG_TEXT) + r")<",
+    re.IGNORECASE | re.DOTALL,
+)
+
 
 class LinkFinder(HTMLParser):
     """Finds EOF download links in aux.sentinel1.eo.esa.int page
@@ -34,7 +58,7 @@ class LinkFinder(HTMLParser):
     """
 
     def __init__(self, verbose=True, nisar=True, split_products=True):
-        HTMLParser.__init__(self)
+        super().__init__()
         self.products = []
         self.links = []
         self.verbose = verbose
@@ -47,25 +71,47 @@ class LinkFinder(HTMLParser):
                 if name == "href":
                     self.links.append(value)
                     if self.verbose:
-                        print(value)
+                        log.debug("Found link: %s", value)
                     # For the first attempt at gathering product names,
                     # result is like "/cgi-bin/product.pl?jobName={product}"
                     if self._split_products:
                         product = value.split("=")[1]
                         self.products.append(product)
                         if self.verbose:
-                            print(product)
+                            log.debug("Found product: %s", product)
 
     def handle_data(self, data):
         # This is inside a <small> tag after the NISAR version
-        if not self.nisar and data == "#simulated-nisar #dithered":
+        if not self.nisar and data == NISAR_TAG_TEXT:
             self.products.pop()
 
+    @classmethod
+    def from_text(cls, text, **kwargs):
+        """Find the links in `text` with one regex pass instead of `feed`
 
-class Base(object):
+        Gives the same `links`/`products` as `feed`, but without running
+        the pure-python HTML tokenizer. `kwargs` are passed to `LinkFinder`.
+        """
+        lf = cls(**kwargs)
+        for match in LINK_OR_NISAR_RE.finditer(text):
+            if match.group("skip"):
+                continue
+            if match.group("nisar_tag"):
+                lf.handle_data(match.group("nisar_tag"))
+                continue
+            value = next(v for v in match.group("dq", "sq", "uq") if v is not None)
+            lf.handle_starttag("a", [("href", unescape(value))])
+        return lf
+
+
+class Base:
     """Base parser to illustrate expected interface/ minimum data available"""
 
+    # Parsers get made once per file in a search, so skip the per-instance __dict__
+    __slots__ = ("filename", "data_dict", "verbose")
+
     FILE_REGEX = None
+    FILE_RE = None  # Compiled FILE_REGEX
     TIME_FMT = None
 
     def __init__(self, filename, verbose=False):
@@ -99,7 +145,10 @@ class Base(object):
         if not self.FILE_REGEX:
             raise NotImplementedError("Must define class FILE_REGEX to parse")
 
-        match = re.search(self.FILE_REGEX, self.filename)
+        if self.FILE_RE is not None:
+            match = self.FILE_RE.search(self.filename)
+        else:
+            match = re.search(self.FILE_REGEX, self.filename)
         if not match:
             raise ValueError(
                 "Invalid {} filename: {}".format(self.__class__.__name__, self.filename)
@@ -109,7 +158,8 @@ class Base(object):
 
     def _get_field(self, fieldname):
         """Pick a specific field based on its name"""
-        return self.full_parse()[fieldname]
+        # Parsed once in __init__
+        return self.data_dict[fieldname]
 
     def __getitem__(self, item):
         """Access properties with uavsar[item] syntax"""
@@ -155,19 +205,10 @@ class Uavsar(Base):
 
     """
 
-    FILE_REGEX = (
-        r"(?P<target_site>[\w\d]{6})_"
-        # r"(?P<heading>\d{3})(?P<counter>\w+)_" # this is lineID
-        r"(?P<line_id>\d{5})_"
-        # r"(?P<year>\d{2})(?P<flight_number>\d{3})_" # this is FlightID
-        r"(?P<flight_id>\d{5})_"
-        r"(?P<data_take>\d{3})_"
-        r"(?P<date>\d{6})_"
-        r"(?P<band_squint_pol>\w{0,8})_"
-        r"(?P<xtalk>X|C)(?P<dither>[XGD])_"
-        r"(?P<nmode>\w{3,4})?_?"
-        r"(?P<version>\d{2})\.?(?P<ext>\w{2,5})?"
-    )
+    __slots__ = ()
+
+    FILE_REGEX = UAVSAR_NAME_REGEX + r"(?P<version>\d{2})\.?(?P<ext>\w{2,5})?"
+    FILE_RE = re.compile(FILE_REGEX)
     TIME_FMT = "%y%m%d"
 
     @property
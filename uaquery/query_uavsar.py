@@ -6,35 +6,25 @@ Specify the --nisar-mode for getting only NISAR-simulated products
 Author: Scott Staniewicz
 Date: 2021-06-01
 """
-import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
+import json
 import os
-import subprocess
+import time
+from urllib.parse import urlencode, urlparse
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from . import parsers
 from . import create_netrc
 from .logger import get_log
 
 log = get_log()
 
-try:
-    from concurrent.futures import ThreadPoolExecutor
-
-    PARALLEL = True
-    MAX_WORKERS = 10  # Number of concurrent requests
-except ImportError:
-    log.warning(
-        "'futures' package not installed for python2. "
-        "url search will not be parallel. Run `pip install futures` "
-        "for speed up searches for many products. "
-    )
-    PARALLEL = False
-
-if sys.version_info.major == 2:
-    from urllib import urlencode
-else:
-    from urllib.parse import urlencode
-
+# Most concurrent requests to the UAVSAR server (override with UAQUERY_MAX_WORKERS)
+MAX_WORKERS = int(os.environ.get("UAQUERY_MAX_WORKERS", 10))
 
 # URL for all UAVSAR searches
 BASE_URL = "https://uavsar.jpl.nasa.gov/cgi-bin/data.pl?{params}"
@@ -50,8 +40,65 @@ INFO_URL = "https://uavsar.jpl.nasa.gov/cgi-bin/product.pl?jobName={product}"
 # https://uavsar.jpl.nasa.gov/cgi-bin/product.pl?jobName=SanAnd_23511_14128_002_140829_L090_CX_02#data
 
 
+# Seconds to wait on the UAVSAR server before giving up on a request
+REQUEST_TIMEOUT = 10
+
+
+# Number of files to download at once, and bytes read per write while downloading
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_CHUNK_BYTES = 1 << 20
+# Bytes written between dropping a download's older pages from the page cache
+DOWNLOAD_DROP_BYTES = 64 << 20
+
+
+class _EarthdataSession(requests.Session):
+    """Session which keeps the user's credentials through the redirect to
+    the NASA Earthdata login (requests drops them when the host changes)
+    """
+
+    def rebuild_auth(self, prepared_request, response):
+        redirect_host = urlparse(prepared_request.url).hostname
+        if (
+            redirect_host == create_netrc.NASAHOST
+            and "Authorization" in prepared_request.headers
+        ):
+            return
+        super().rebuild_auth(prepared_request, response)
+
+
+def _make_session(pool_size=32):
+    """Make a Session whose keep-alive connections are shared by all requests
+
+    Reusing the sockets skips a new TCP+TLS handshake for each query to the
+    (single) UAVSAR host, and `pool_size` lets all worker threads keep one open.
+    """
+    session = _EarthdataSession()
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        # The CGI server answers 502-504 when it's busy: worth a retry
+        max_retries=Retry(
+            total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504)
+        ),
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+_SESSION = _make_session()
+
+
+# Download links found for each product, kept between searches for other
+# file types/pols. Entries older than `LINKS_CACHE_MAX_AGE` seconds are searched
+# again (and dropped from the file), in case a product's page was still being
+# filled in when it was saved. Skip the cache with `no_cache=True` (`--no-cache`)
+PRODUCT_LINKS_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "uaquery", "product_links.json"
+)
+LINKS_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
 # Loaction to save URLS, which is file-type/pol-specific
-URL_FILE_DEFAULT = "uavsar_download_urls_{file_type}{pol}{nisar_mode}.txt"
+URL_FILE_DEFAULT = "uavsar_download_urls_{flight_line}_{file_type}{pol}{nisar_mode}.txt"
 
 # Format used in UAVSAR API for searching dates
 DATE_FMT = "%y%m%d"
@@ -61,7 +108,9 @@ MODE_CHOICES_H5 = ["129", "138", "143"]
 MODE_CHOICES = [num + ab for num in MODE_CHOICES_H5 for ab in ["a", "b"]]
 
 # These files have no polarization in file name (e.g. only L090, not L090VV)
-NO_POL_FILETYPES = ("ann", "inc", "flat.inc", "slope", "rtc", "dat", "hgt", "kmz", "h5")
+NO_POL_FILETYPES = frozenset(
+    ("ann", "inc", "flat.inc", "slope", "rtc", "dat", "hgt", "kmz", "h5")
+)
 POLARIZATION_CHOICES = [
     p.lower() for p in parsers.SINGLE_POLARIZATIONS + parsers.CROSS_POLARIZATIONS
 ]
@@ -81,6 +130,7 @@ def download(
     url_file=URL_FILE_DEFAULT,
     out_dir=".",
     verbose=True,
+    no_cache=False,
     **kwargs
 ):
     """Gather all download urls associated with one flight line
@@ -99,11 +149,13 @@ def download(
         start_date (str or datetime): starting date to limit search. If str, format = YYMMDD
         end_date (str or datetime): ending date to limit search. If str, format = YYMMDD
         url_file (str): Name of file to save urls from query.
-            default= "uavsar_download_urls_FILE_TYPE.txt", e.g.
-            "uavsar_download_urls_h5.txt" for the HDF5 files
+            default= "uavsar_download_urls_FLIGHT_LINE_FILE_TYPE.txt", e.g.
+            "uavsar_download_urls_14511_h5.txt" for the HDF5 files
         out_dir (str): Directory to save downloaded products. Default=current directory.
             If out_dir doesn't exist, will create.
         verbose (bool): Print debug information (default=True)
+        no_cache (bool): Search every product's download links again, instead of
+            reusing ones saved in `PRODUCT_LINKS_CACHE` (default=False)
 
     Returns:
         url_list (list[str]): urls for downloading each data product
@@ -129,19 +181,72 @@ def download(
         end_date=end_date,
         url_file=url_file,
         verbose=verbose,
+        no_cache=no_cache,
     )
-    for url in url_list:
-        cmd = "wget --no-clobber {url}".format(url=url)
-        if username and password:
-            cmd += " --user={} --password={}".format(username, password)
+    auth = (username, password) if username and password else None
+    num_workers = max(1, min(DOWNLOAD_WORKERS, len(url_list)))
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        # list() to raise any errors from the downloads
+        list(executor.map(lambda url: _download_url(url, out_dir, auth), url_list))
+
 
-        log.info(cmd)
-        subprocess.check_call(cmd, shell=True)
+def _download_url(url, out_dir=".", auth=None):
+    """Stream one file from `url` into `out_dir`, skipping files already there
 
-        # Move the output from wget into the output dir, if specified
-        if out_dir != ".":
-            saved_file = url.split("/")[-1]
-            os.rename(saved_file, os.path.join(out_dir, saved_file))
+    Data is written to a ".part" file first, so an interrupted download
+    won't be mistaken for a finished one next time. If a ".part" file exists,
+    the download resumes from where it stopped (when the server allows).
+    """
+    dest = os.path.join(out_dir, url.split("/")[-1])
+    if os.path.exists(dest):
+        log.info("{} already exists, skipping".format(dest))
+        return dest
+    tmp_file = dest + ".part"
+    headers = {}
+    if os.path.exists(tmp_file):
+        headers["Range"] = "bytes={}-".format(os.path.getsize(tmp_file))
+        log.info("Resuming {} to {} ({})".format(url, dest, headers["Range"]))
+    else:
+        log.info("Downloading {} to {}".format(url, dest))
+    resp = _SESSION.get(
+        url, auth=auth, headers=headers, stream=True, timeout=REQUEST_TIMEOUT
+    )
+    try:
+        # 416: the ".part" file already has every byte
+        if not (headers and resp.status_code == 416):
+            resp.raise_for_status()
+            # Servers ignoring the Range header send the whole file again
+            mode = "ab" if resp.status_code == 206 else "wb"
+            with open(tmp_file, mode) as f:
+                start = dropped = f.tell()
+                for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                    f.write(chunk)
+                    # Skip the newest pages, which the OS is likely still writing
+                    if f.tell() - dropped >= 2 * DOWNLOAD_DROP_BYTES:
+                        end = f.tell() - DOWNLOAD_DROP_BYTES
+                        _drop_from_page_cache(f, dropped, end)
+                        dropped = end
+                # Pages skipped above were dirty, so sync once to drop them all
+                _drop_from_page_cache(f, start, f.tell(), sync=True)
+    finally:
+        resp.close()
+    os.rename(tmp_file, dest)
+    return dest
+
+
+def _drop_from_page_cache(f, start, end, sync=False):
+    """Tell the OS we won't reread bytes `start` to `end` of `f`, so multi-GB
+    downloads don't push everything else out of the page cache
+
+    Pages not yet written to disk are kept, unless `sync` first waits for
+    the disk to catch up (no-op where unsupported)
+    """
+    if not hasattr(os, "posix_fadvise") or end <= start:
+        return
+    if sync:
+        f.flush()
+        os.fdatasync(f.fileno())
+    os.posix_fadvise(f.fileno(), start, end - start, os.POSIX_FADV_DONTNEED)
 
 
 def find_data_urls(
@@ -153,6 +258,7 @@ def find_data_urls(
     end_date=None,
     url_file=URL_FILE_DEFAULT,
     verbose=True,
+    no_cache=False,
     **kwargs
 ):
     """Search and save download urls for a flight line.
@@ -168,15 +274,34 @@ def find_data_urls(
 
     if url_file == URL_FILE_DEFAULT:
         url_file = URL_FILE_DEFAULT.format(
+            flight_line=flight_line,
             file_type=file_type_nodot,
             pol=pol,
             nisar_mode=nisar_mode or "",
         )
     log.info("url_file = {}".format(url_file))
+    # The search behind `url_file` is saved next to it, so a file left from a
+    # different search (e.g. other dates with the same --url-file) isn't reused
+    meta_file = url_file + ".meta.json" if url_file else None
+    search_key = {
+        "search_url": form_search_url(
+            flight_line=flight_line,
+            start_date=start_date,
+            end_date=end_date,
+            nisar=bool(nisar_mode),
+        ),
+        "file_type": file_type_nodot,
+        "pol": pol,
+        "nisar_mode": nisar_mode or "",
+    }
     if url_file and os.path.exists(url_file):
-        log.info("Found existing {} to read from.".format(url_file))
-        with open(url_file) as f:
-            return f.read().splitlines()
+        saved_key = _load_search_cache(meta_file).get("key")
+        # (no saved search for url files written by hand or by older versions)
+        if saved_key is None or saved_key == search_key:
+            log.info("Found existing {} to read from.".format(url_file))
+            with open(url_file) as f:
+                return f.read().splitlines()
+        log.info("{} is from a different search, searching again".format(url_file))
 
     product_list = find_uavsar_products(
         flight_line,
@@ -184,30 +309,38 @@ def find_data_urls(
         end_date=end_date,
         nisar=bool(nisar_mode),
         verbose=verbose,
+        cache_file=meta_file,
+        cache_key=search_key,
     )
     url_list = []
     log.info("Finding urls for {} products".format(len(product_list)))
 
-    if PARALLEL:
-        # Search `MAX_WORKERS` locations in parallel for the products' urls
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            links_per_product = executor.map(_query_product_urls, product_list)
-    else:
-        # Just run search in serial
-        links_per_product = [_query_product_urls(product) for product in product_list]
+    # Only ask the server about products not seen in a recent search
+    links_cache = {} if no_cache else _load_links_cache()
+    new_products = [p for p in product_list if p not in links_cache]
+    # Search up to `MAX_WORKERS` locations in parallel for the products' urls,
+    # with no idle threads when there are fewer products than that
+    num_workers = max(1, min(MAX_WORKERS, len(new_products)))
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        new_links = list(executor.map(_query_product_urls, new_products))
+    # Empty results may be a server hiccup, so don't remember those
+    now = time.time()
+    found = dict(
+        (p, [now, links]) for p, links in zip(new_products, new_links) if links
+    )
+    links_cache.update(found)
+    if found and not no_cache:
+        _save_links_cache(links_cache)
+    links_per_product = [links_cache.get(p, [0, []])[1] for p in product_list]
 
     # Now will all possible download urls, find the one based on pol/file type/...
     for all_links, product in zip(links_per_product, product_list):
         data = _form_dataname(
             product, nisar_mode=nisar_mode, file_type=file_type_nodot, pol=pol
         )
-        matching_links = list(set([link for link in all_links if data in link]))
-        if len(matching_links) >= 2:
-            raise ValueError(
-                "Found more then 1 matching link? {}".format(matching_links)
-            )
-        elif len(matching_links) == 1:
-            url_list.append(matching_links[0])
+        url = _match_link(all_links, data)
+        if url:
+            url_list.append(url)
         else:
             log.info(
                 "WARNING: no successful download url from {} for {}. "
@@ -222,21 +355,82 @@ def find_data_urls(
     return url_list
 
 
+def _match_link(links, data):
+    """Find the link to the file named `data`, or None if there isn't one"""
+    # Links end in the file name, so look that up directly
+    by_name = {link.rsplit("/", 1)[-1]: link for link in links}
+    if data in by_name:
+        return by_name[data]
+    matching_links = list(set([link for link in links if data in link]))
+    if len(matching_links) >= 2:
+        raise ValueError("Found more then 1 matching link? {}".format(matching_links))
+    return matching_links[0] if matching_links else None
+
+
 def _query_product_urls(product):
     """Use the URL called by the product page to find all downloadable links
     E.g., for product SanAnd_23511_14068_001_140529_L090_CX_01, parse the HTML for links at
     https://uavsar.jpl.nasa.gov/cgi-bin/query_asf.pl?job_name=SanAnd_23511_14068_001_140529_L090_CX_01
     """
     log.info("searching release urls for product = {}".format(product))
-    resp = requests.get(PRODUCT_LIST_URL.format(product=product))
-    lf = parsers.LinkFinder(verbose=False, split_products=False)
-    lf.feed(resp.text)
+    resp = _SESSION.get(
+        PRODUCT_LIST_URL.format(product=product), timeout=REQUEST_TIMEOUT
+    )
+    lf = parsers.LinkFinder.from_text(resp.text, verbose=False, split_products=False)
     return [link for link in lf.links if product in link and link.startswith("http")]
 
 
+def _load_links_cache(cache_file=PRODUCT_LINKS_CACHE, max_age=LINKS_CACHE_MAX_AGE):
+    """Read the {product: [time saved, links]} saved in the last `max_age` seconds"""
+    if not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+    except ValueError:
+        log.warning("Ignoring unreadable link cache {}".format(cache_file))
+        return {}
+    oldest = time.time() - max_age
+    # (entries from before the save time was added are plain lists of links)
+    return dict(
+        (product, entry)
+        for product, entry in cached.items()
+        if entry and isinstance(entry[0], (int, float)) and entry[0] >= oldest
+    )
+
+
+def _save_links_cache(links_cache, cache_file=PRODUCT_LINKS_CACHE):
+    """Save the {product: [time saved, links]} from `_load_links_cache`
+
+    Expired entries were already left out when loading, so the file
+    doesn't keep growing.
+    """
+    try:
+        mkdir_p(os.path.dirname(cache_file))
+        with open(cache_file, "w") as f:
+            json.dump(links_cache, f)
+    except OSError as e:
+        # Only a speedup for later searches; don't fail this one
+        log.warning("Could not save link cache {}: {}".format(cache_file, e))
+
+
+@lru_cache(maxsize=4096)
+def _parse_product(product):
+    """Parse `product` with `parsers.Uavsar`, reusing the result on repeat calls"""
+    return parsers.Uavsar(product)
+
+
+@lru_cache(maxsize=4096)
 def _form_dataname(product, file_type=".slc", nisar_mode="129a", pol="vv"):
     """Combine the product, file-type, nisar mode, and polarization
     to make the correct file name to download
+
+    >>> _form_dataname("Snjoaq_14511_18034_014_180823_L090_CX_02", ".h5", "129A")
+    'Snjoaq_14511_18034_014_180823_L090VV_CX_129_02.h5'
+    >>> _form_dataname("Snjoaq_14511_18034_014_180823_L090_CX_129_02", ".slc", None)
+    'Snjoaq_14511_18034_014_180823_L090VV_CX_129_02.slc'
+    >>> _form_dataname("Snjoaq_14511_18034_014_180823_L090_CX_129_02", ".slc", "138a")
+    'Snjoaq_14511_18034_014_180823_L090VV_CX_138A_129_02.slc'
     """
     file_type_nodot = file_type.lstrip(".").lower()
 
@@ -246,18 +440,25 @@ def _form_dataname(product, file_type=".slc", nisar_mode="129a", pol="vv"):
         # only HDF5 files have the NISAR mode stripped, inlcudes both
         nisar_mode = nisar_mode.strip("AB")
 
-    # pol is placed in the "band_squint_pol" field
-    parsed = parsers.Uavsar(product)
-    if pol:
-        bsp = parsed["band_squint_pol"]
-        product = product.replace(bsp, bsp + pol)
-    xtalk = parsed["xtalk"]
-    dither = parsed["dither"]
+    # Build the name from its fields: pol is placed in the "band_squint_pol" field,
+    # and the NISAR mode goes after the crosstalk/dither field (before any mode
+    # already in the name)
+    parsed = _parse_product(product)
+    fields = [
+        parsed["target_site"],
+        parsed["line_id"],
+        parsed["flight_id"],
+        parsed["data_take"],
+        parsed["date"],
+        parsed["band_squint_pol"] + pol,
+        parsed["xtalk"] + parsed["dither"],
+    ]
     if nisar_mode:
-        before = "_" + xtalk + dither + "_"
-        after = before + nisar_mode + "_"
-        product = product.replace(before, after)
-    return product + "." + file_type_nodot
+        fields.append(nisar_mode)
+    if parsed["nmode"]:
+        fields.append(parsed["nmode"])
+    fields.append(parsed["version"])
+    return "_".join(fields) + "." + file_type_nodot
 
 
 def mkdir_p(path):
@@ -281,12 +482,20 @@ def find_uavsar_products(
     end_date=None,
     nisar=False,
     verbose=True,
+    cache_file=None,
+    cache_key=None,
 ):
     """Parse the query results for one flight line, scraping the url for all
     related products.
 
-    The url from `form_search_url` gives just an HTML snippet, which is parsed by
-    `LinkFinder` for all the <a> tags
+    The url from `form_search_url` gives just an HTML snippet, which is scanned
+    by `LinkFinder.from_text` for all the <a> tags
+
+    If `cache_file` is given, the products are saved there along with the
+    ETag/Last-Modified of the response, and later searches send a conditional
+    GET: a 304 response reuses the saved products without a download or parse.
+    `cache_key` is an optional dict saved with them (with the search url), which
+    must match for the saved products to be reused.
     """
     search_url = form_search_url(
         flight_line=flight_line,
@@ -295,32 +504,69 @@ def find_uavsar_products(
         nisar=nisar,
     )
     log.info("Querying {}".format(search_url))
-    response = requests.get(search_url)
-    lf = parsers.LinkFinder(verbose=False, nisar=nisar)
-    lf.feed(response.text)
-    all_products = _remove_duplicates(lf.products)
+    key = dict(cache_key or {}, search_url=search_url)
+    cached = _load_search_cache(cache_file)
+    if cached.get("key") != key:
+        cached = {}
+    headers = {}
+    if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    response = _SESSION.get(search_url, headers=headers, timeout=REQUEST_TIMEOUT)
+    if response.status_code == 304 and cached.get("products"):
+        log.info("Search results unchanged, using {}".format(cache_file))
+        all_products = cached["products"]
+    else:
+        lf = parsers.LinkFinder.from_text(response.text, verbose=False, nisar=nisar)
+        all_products = _remove_duplicates(lf.products)
+        _save_search_cache(cache_file, key, response, all_products)
     if verbose:
         for product in all_products:
             log.info(INFO_URL.format(product=product))
     return all_products
 
 
-def _remove_duplicates(product_list):
-    product_list = sorted(product_list, reverse=True)
-    out = [product_list[0]]
-    for idx, cur_name in enumerate(product_list[1:], start=1):
-        prev_name = product_list[idx - 1]
-        prev, cur = parsers.Uavsar(prev_name), parsers.Uavsar(cur_name)
-        if (
-            prev.line_id == cur.line_id
-            and prev.flight_id == cur.flight_id
-            and prev.data_take == cur.data_take
-        ):
-            continue
+def _load_search_cache(cache_file):
+    """Read the saved search results, or {} if there are none"""
+    if not cache_file or not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except ValueError:
+        log.warning("Ignoring unreadable search cache {}".format(cache_file))
+        return {}
+
+
+def _save_search_cache(cache_file, key, response, products):
+    """Save `products` for the search `key`, with any validators the server sent"""
+    if not cache_file:
+        return
+    cached = {
+        "key": key,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "products": products,
+    }
+    try:
+        with open(cache_file, "w") as f:
+            json.dump(cached, f)
+    except OSError as e:
+        # Only a speedup for later searches; don't fail this one
+        log.warning("Could not save search cache {}: {}".format(cache_file, e))
 
-        out.append(cur_name)
 
-    return sorted(out)
+def _remove_duplicates(product_list):
+    """Keep one product per (line, flight, data take): the latest version"""
+    latest = {}
+    for name in product_list:
+        parsed = _parse_product(name)
+        key = (parsed.line_id, parsed.flight_id, parsed.data_take)
+        if name > latest.get(key, ""):
+            latest[key] = name
+    return sorted(latest.values())
 
 
 def form_search_url(
@@ -336,6 +582,7 @@ def form_search_url(
     if isinstance(end_date, datetime):
         end_date = end_date.strftime(DATE_FMT)
 
+    bands = "L-band,simulated-nisar" if nisar else "L-band"
     # These all seem to be required for the UAVSAR query to work
     params = [
         ("fname", "searchUavsar"),
@@ -347,8 +594,8 @@ def form_search_url(
         ("endDate", end_date),
         ("args", "PolSAR"),
         ("modeList", "PolSAR"),
-        ("args", "L-band,simulated-nisar" if nisar else "L-band"),
-        ("bandList", "L-band,simulated-nisar" if nisar else "L-band"),
+        ("args", bands),
+        ("bandList", bands),
         ("args", "single-pol,quad-pol"),
         ("polList", "single-pol,quad-pol"),
         ("args", flight_line),